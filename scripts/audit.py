@@ -0,0 +1,358 @@
+"""
+Buffered Audit Trail for invoice processing runs
+"""
+import atexit
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+import zlib
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+try:
+    import yaml
+except ImportError:  # PyYAML missing - fall back to defaults
+    yaml = None
+
+SETTINGS_FILE = Path(__file__).parent.parent / 'config' / 'settings.yaml'
+
+# Environment override for security.audit_trail (e.g. AUDIT_TRAIL_ENABLED=false)
+ENABLED_ENV_VAR = 'AUDIT_TRAIL_ENABLED'
+
+SEGMENT_PREFIX = 'audit-'
+SEGMENT_SUFFIX = '.jsonl.gz'
+
+DEFAULT_SETTINGS = {
+    'audit_trail': False,
+    'audit': {
+        'directory': './logs/audit',
+        'batch_size': 500,
+        'flush_interval': 2.0,
+        'retention_days': 365,
+    },
+    'retention': {
+        'log_files_days': 30,
+    },
+    'log_file': None,
+}
+
+
+def load_security_settings(settings_file=None):
+    """Load the audit-related settings from settings.yaml merged over the defaults."""
+    if settings_file is None:
+        settings_file = SETTINGS_FILE
+    settings = {
+        'audit_trail': DEFAULT_SETTINGS['audit_trail'],
+        'audit': dict(DEFAULT_SETTINGS['audit']),
+        'retention': dict(DEFAULT_SETTINGS['retention']),
+        'log_file': DEFAULT_SETTINGS['log_file'],
+    }
+    config = {}
+    if yaml is not None and os.path.exists(settings_file):
+        try:
+            with open(settings_file, 'r', encoding='utf-8') as f:
+                config = yaml.safe_load(f) or {}
+        except Exception as e:
+            print(f"Error reading audit settings: {e}")
+
+    security = config.get('security') or {}
+    logging_config = config.get('logging') or {}
+    settings['audit_trail'] = bool(security.get('audit_trail', settings['audit_trail']))
+    settings['audit'].update(security.get('audit') or {})
+    settings['retention'].update(security.get('retention') or {})
+    _validate_number(settings, 'audit', 'batch_size', int, 1)
+    _validate_number(settings, 'audit', 'flush_interval', float, 0)
+    _validate_number(settings, 'audit', 'retention_days', int, 0)
+    _validate_number(settings, 'retention', 'log_files_days', int, 0)
+    if logging_config.get('file_enabled'):
+        settings['log_file'] = logging_config.get('file_path')
+
+    override = os.environ.get(ENABLED_ENV_VAR, '').strip().lower()
+    if override in ('1', 'true', 'yes', 'on'):
+        settings['audit_trail'] = True
+    elif override in ('0', 'false', 'no', 'off'):
+        settings['audit_trail'] = False
+    return settings
+
+
+def _validate_number(settings, section, key, convert, minimum):
+    """Convert a numeric setting in place, falling back to its default when invalid."""
+    value = settings[section].get(key)
+    try:
+        number = convert(value)
+        if number < minimum:
+            raise ValueError(f"must be at least {minimum}")
+    except (TypeError, ValueError) as e:
+        default = DEFAULT_SETTINGS[section][key]
+        print(f"Invalid audit setting {section}.{key}={value!r} ({e}), using {default}")
+        number = default
+    settings[section][key] = number
+
+
+def new_run_id():
+    """Create an identifier for one automation run."""
+    return f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+def segment_name(day, run_id):
+    """Return the segment file name for one run on one day."""
+    return f"{SEGMENT_PREFIX}{day.isoformat()}-{run_id}{SEGMENT_SUFFIX}"
+
+
+def segment_date(path):
+    """Return the date prefix of a segment file name, or None if it is not a segment."""
+    name = Path(path).name
+    if not (name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)):
+        return None
+    stem = name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]
+    if len(stem) > 10 and stem[10] != '-':
+        return None
+    try:
+        return date.fromisoformat(stem[:10])
+    except ValueError:
+        return None
+
+
+def sweep_retention(audit_dir, audit_days=None, log_file=None, log_days=None, today=None):
+    """Delete audit segments and rotated logs older than their retention windows.
+
+    Audit segments (security.audit.retention_days) are aged by the date in
+    their file name and rotated log files (security.retention.log_files_days)
+    by their modification time, so no file is ever opened or read.
+    Returns the list of removed paths.
+    """
+    today = today or date.today()
+    removed = []
+
+    if audit_days is not None and os.path.isdir(audit_dir):
+        cutoff = today - timedelta(days=int(audit_days))
+        for entry in os.scandir(audit_dir):
+            day = segment_date(entry.name)
+            if day is not None and day < cutoff:
+                os.remove(entry.path)
+                removed.append(entry.path)
+
+    if log_days is not None and log_file:
+        log_dir = os.path.dirname(log_file) or '.'
+        base = os.path.basename(log_file)
+        cutoff = time.time() - int(log_days) * 86400
+        if os.path.isdir(log_dir):
+            for entry in os.scandir(log_dir):
+                # Only rotated copies (automation.log.1, ...); never the live log
+                if entry.name.startswith(base + '.') and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed.append(entry.path)
+
+    return removed
+
+
+class AuditTrail:
+    """Append-only audit log with buffered, group-committed writes.
+
+    `record()` only enqueues the event; a background thread drains the
+    queue and appends each batch as one gzip member, followed by a single
+    fsync. Each run writes its own segment per day, so separate processes
+    never interleave writes and a crash can only cut off the run's own
+    final member.
+    """
+
+    _STOP = object()
+
+    def __init__(self, directory, batch_size=500, flush_interval=2.0,
+                 enabled=True, run_id=None):
+        self.directory = Path(directory)
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = float(flush_interval)
+        self.enabled = enabled
+        self.run_id = run_id or new_run_id()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def record(self, event, **fields):
+        """Buffer a single audit event."""
+        self.record_many(event, [fields])
+
+    def record_many(self, event, rows):
+        """Buffer one audit event per entry of `rows` with a single queue put.
+
+        Never raises: auditing must not change the outcome of the step
+        being audited.
+        """
+        if not self.enabled:
+            return
+        try:
+            timestamp = datetime.now().isoformat(timespec='milliseconds')
+            events = [{'ts': timestamp, 'run_id': self.run_id, 'event': event, **row}
+                      for row in rows]
+            if not events:
+                return
+            # Holding the lock keeps every accepted event ahead of close()'s stop marker
+            with self._lock:
+                if self._closed or not self._start_writer():
+                    return
+                self._queue.put(events)
+        except Exception as e:
+            print(f"Error recording audit trail: {e}")
+
+    def flush(self, timeout=None):
+        """Block until every event recorded so far has been committed."""
+        with self._lock:
+            if self._closed or self._thread is None or not self._thread.is_alive():
+                return True
+            done = threading.Event()
+            self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=None):
+        """Commit remaining events and stop the writer thread."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+            if thread is not None:
+                self._queue.put(self._STOP)
+        if thread is not None:
+            thread.join(timeout)
+
+    def _start_writer(self):
+        """Start the writer thread if needed; the caller must hold the lock."""
+        if self._thread is not None:
+            return True
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            print(f"Error creating audit directory, audit trail disabled: {e}")
+            self.enabled = False
+            return False
+        self._thread = threading.Thread(
+            target=self._run, name='audit-writer', daemon=True)
+        self._thread.start()
+        return True
+
+    def _run(self):
+        pending = []
+        waiters = []
+        deadline = None
+        stopping = False
+
+        while not stopping:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is self._STOP:
+                stopping = True
+            elif isinstance(item, threading.Event):
+                waiters.append(item)
+            elif item is not None:
+                pending.extend(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            timed_out = deadline is not None and time.monotonic() >= deadline
+            if pending and (stopping or waiters or timed_out
+                            or len(pending) >= self.batch_size):
+                self._commit(pending)
+                pending = []
+                deadline = None
+            for waiter in waiters:
+                waiter.set()
+            waiters = []
+
+    def _commit(self, events):
+        """Append a batch as one gzip member and fsync once."""
+        segment = self.directory / segment_name(date.today(), self.run_id)
+        payload = ''.join(json.dumps(e, default=str) + '\n' for e in events)
+        try:
+            with open(segment, 'ab') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb') as gz:
+                    gz.write(payload.encode('utf-8'))
+                raw.flush()
+                os.fsync(raw.fileno())
+        except Exception as e:
+            print(f"Error writing audit trail: {e}")
+
+
+def read_segment(path):
+    """Yield the events of one segment, stopping at a cut-off or corrupt member.
+
+    Members are decoded one at a time so every complete group commit before
+    a crash stays readable.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    while data:
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        try:
+            payload = decompressor.decompress(data)
+        except zlib.error:
+            return
+        if not decompressor.eof:
+            return
+        for line in payload.decode('utf-8').splitlines():
+            if line.strip():
+                yield json.loads(line)
+        data = decompressor.unused_data
+
+
+def read_events(directory):
+    """Yield every committed audit event, oldest segment first."""
+    for path in sorted(Path(directory).glob(f"{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}")):
+        yield from read_segment(path)
+
+
+_audit_trail = None
+_audit_lock = threading.Lock()
+
+
+def get_audit_trail():
+    """Return the process-wide audit trail, configured from settings.yaml.
+
+    The retention sweep runs once, when the trail is first created.
+    """
+    global _audit_trail
+    with _audit_lock:
+        if _audit_trail is None:
+            settings = load_security_settings()
+            audit = settings['audit']
+            try:
+                _audit_trail = AuditTrail(
+                    audit['directory'],
+                    batch_size=audit['batch_size'],
+                    flush_interval=audit['flush_interval'],
+                    enabled=settings['audit_trail'],
+                )
+            except Exception as e:
+                print(f"Error configuring audit trail, audit trail disabled: {e}")
+                _audit_trail = AuditTrail(DEFAULT_SETTINGS['audit']['directory'], enabled=False)
+            if _audit_trail.enabled:
+                try:
+                    sweep_retention(audit['directory'], audit_days=audit['retention_days'],
+                                    log_file=settings['log_file'],
+                                    log_days=settings['retention']['log_files_days'])
+                except Exception as e:
+                    print(f"Error applying audit retention: {e}")
+                atexit.register(_audit_trail.close)
+        return _audit_trail
+
+
+def set_audit_trail(trail):
+    """Replace the process-wide audit trail and return the previous one.
+
+    Lets callers and tests inject their own trail instead of the one built
+    from settings.yaml; pass None to rebuild it from settings on next use.
+    """
+    global _audit_trail
+    with _audit_lock:
+        previous = _audit_trail
+        _audit_trail = trail
+    return previous
@@ -4,9 +4,11 @@ Simple Report Generator for Invoice Data
 import pandas as pd
 from datetime import datetime
 import os
+from audit import get_audit_trail
 
-def generate_report(processed_data_file, output_file):
+def generate_report(processed_data_file, output_file, audit_trail=None):
     """Generate a simple Excel report from processed invoice data."""
+    audit = audit_trail if audit_trail is not None else get_audit_trail()
     try:
         # Read processed data
         df = pd.read_excel(processed_data_file)
@@ -34,10 +36,15 @@ def generate_report(processed_data_file, output_file):
             summary_df.to_excel(writer, sheet_name='Summary', index=False)
         
         print(f"Report generated successfully: {output_file}")
+        audit.record(
+            'report_generated', source=processed_data_file, output=output_file,
+            invoice_ids=df['InvoiceID'].tolist() if 'InvoiceID' in df.columns else [],
+            total_invoices=total_invoices, total_amount=float(total_amount))
         return True
         
     except Exception as e:
         print(f"Error generating report: {e}")
+        audit.record('report_failed', source=processed_data_file, error=str(e))
         return False
 
 if __name__ == "__main__":
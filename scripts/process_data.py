@@ -3,14 +3,19 @@ Simple Invoice Data Processing
 """
 import pandas as pd
 import os
+from audit import get_audit_trail
 
-def process_invoices(input_file, output_file):
+def process_invoices(input_file, output_file, audit_trail=None):
     """Process invoice data from Excel file and save to output file."""
+    audit = audit_trail if audit_trail is not None else get_audit_trail()
     try:
         # Read the input data
         print(f"Reading data from: {input_file}")
         df = pd.read_excel(input_file)
         
+        # Snapshot the cleaned columns only when their changes will be audited
+        original = df[['Status', 'Amount', 'Client']].copy() if audit.enabled else None
+        
         # Clean and standardize data
         df['Status'] = df['Status'].str.upper()
         df['Amount'] = df['Amount'].apply(lambda x: round(x, 2))
@@ -24,10 +29,25 @@ def process_invoices(input_file, output_file):
         print(f"Processed data saved to: {output_file}")
         print(f"Processed {len(df)} records")
         
+        # Audit which invoices were processed and which fields were altered
+        if audit.enabled:
+            changed = (df[original.columns].ne(original) & original.notna()).to_numpy()
+            altered = [list(original.columns[mask]) for mask in changed]
+            if 'InvoiceID' in df.columns:
+                invoice_ids = df['InvoiceID'].tolist()
+            else:
+                invoice_ids = [None] * len(df)
+            audit.record_many('invoice_processed', (
+                {'invoice_id': invoice_id, 'row': row, 'altered_fields': fields,
+                 'source': input_file, 'output': output_file}
+                for row, (invoice_id, fields) in enumerate(zip(invoice_ids, altered))
+            ))
+        
         return True
         
     except Exception as e:
         print(f"Error processing data: {e}")
+        audit.record('processing_failed', source=input_file, error=str(e))
         return False
 
 if __name__ == "__main__":
@@ -6,9 +6,11 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
 import os
+from audit import get_audit_trail
 
-def send_email(report_file, to_email="recipient@example.com", smtp_config=None):
+def send_email(report_file, to_email="recipient@example.com", smtp_config=None, audit_trail=None):
     """Send email with report attachment."""
+    audit = audit_trail if audit_trail is not None else get_audit_trail()
     
     # Default SMTP configuration (Gmail example)
     if smtp_config is None:
@@ -54,10 +56,12 @@ def send_email(report_file, to_email="recipient@example.com", smtp_config=None):
         server.quit()
         
         print(f"Email sent successfully to {to_email}")
+        audit.record('email_sent', report=report_file, recipient=to_email)
         return True
         
     except Exception as e:
         print(f"Error sending email: {e}")
+        audit.record('email_failed', report=report_file, recipient=to_email, error=str(e))
         print("Note: Configure SMTP settings to enable email functionality")
         return False
 
@@ -0,0 +1,26 @@
+"""
+Shared test configuration
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# Add the scripts directory to the path
+sys.path.insert(0, str(Path(__file__).parent.parent / 'scripts'))
+
+import audit
+
+# Keep automation runs started from tests (including subprocesses) from
+# writing audit segments or sweeping retention in the working tree
+os.environ[audit.ENABLED_ENV_VAR] = 'false'
+
+
+@pytest.fixture(autouse=True)
+def isolated_audit_trail(tmp_path):
+    """Replace the process-wide audit trail with a disabled one under tmp_path."""
+    previous = audit.set_audit_trail(audit.AuditTrail(tmp_path / 'audit', enabled=False))
+    yield
+    audit.set_audit_trail(previous)
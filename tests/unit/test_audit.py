@@ -0,0 +1,481 @@
+"""
+Unit tests for the buffered audit trail
+"""
+
+import pytest
+import gzip
+import os
+import sys
+import threading
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+# Add the scripts directory to the path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent / 'scripts'))
+
+import audit
+
+
+class TestAuditTrail:
+    """Test buffering and group commits."""
+
+    def test_events_are_committed_on_flush(self, tmp_path):
+        """Test that recorded events are readable after a flush."""
+        trail = audit.AuditTrail(tmp_path, batch_size=1000, flush_interval=60, run_id='run-1')
+        try:
+            trail.record('email_sent', report='data/report.xlsx')
+            trail.record_many('invoice_processed', [
+                {'invoice_id': 'INV000001', 'altered_fields': ['Status']},
+                {'invoice_id': 'INV000002', 'altered_fields': []},
+            ])
+            assert trail.flush(timeout=5)
+
+            events = list(audit.read_events(tmp_path))
+            assert [e['event'] for e in events] == ['email_sent', 'invoice_processed', 'invoice_processed']
+            assert all(e['run_id'] == 'run-1' for e in events)
+            assert events[1]['altered_fields'] == ['Status']
+        finally:
+            trail.close(timeout=5)
+
+    def test_segments_are_append_only(self, tmp_path):
+        """Test that later group commits append to the existing segment."""
+        trail = audit.AuditTrail(tmp_path, batch_size=1000, flush_interval=60)
+        try:
+            trail.record('first')
+            trail.flush(timeout=5)
+            trail.record('second')
+            trail.flush(timeout=5)
+        finally:
+            trail.close(timeout=5)
+
+        segments = list(tmp_path.glob('audit-*.jsonl.gz'))
+        assert len(segments) == 1
+        assert [e['event'] for e in audit.read_events(tmp_path)] == ['first', 'second']
+
+    def test_batch_size_triggers_commit(self, tmp_path):
+        """Test that a full batch is committed without waiting for the interval."""
+        trail = audit.AuditTrail(tmp_path, batch_size=2, flush_interval=60)
+        try:
+            started = time.monotonic()
+            trail.record_many('invoice_processed', [{'invoice_id': 'A'}, {'invoice_id': 'B'}])
+            events = []
+            while len(events) < 2 and time.monotonic() - started < 5:
+                time.sleep(0.01)
+                events = list(audit.read_events(tmp_path))
+            assert len(events) == 2
+            assert time.monotonic() - started < trail.flush_interval, \
+                "Batch should be committed before the flush interval elapses"
+        finally:
+            trail.close(timeout=5)
+
+    def test_each_run_writes_its_own_segment(self, tmp_path):
+        """Test that separate trails never append to the same file."""
+        for run_id in ('run-1', 'run-2'):
+            trail = audit.AuditTrail(tmp_path, run_id=run_id)
+            trail.record('report_generated')
+            trail.close(timeout=5)
+
+        segments = sorted(path.name for path in tmp_path.glob('audit-*.jsonl.gz'))
+        assert segments == [audit.segment_name(date.today(), 'run-1'),
+                            audit.segment_name(date.today(), 'run-2')]
+        assert all(audit.segment_date(name) == date.today() for name in segments)
+        assert [e['run_id'] for e in audit.read_events(tmp_path)] == ['run-1', 'run-2']
+
+    def test_truncated_member_keeps_committed_events(self, tmp_path):
+        """Test that a commit cut off mid-write does not hide earlier or other runs' events."""
+        crashed = audit.AuditTrail(tmp_path, run_id='run-1')
+        crashed.record('first')
+        crashed.flush(timeout=5)
+        crashed.record('second')
+        crashed.close(timeout=5)
+
+        segment = tmp_path / audit.segment_name(date.today(), 'run-1')
+        partial = gzip.compress(b'{"event": "lost"}\n' * 100)
+        with open(segment, 'ab') as f:
+            f.write(partial[:len(partial) // 2])
+
+        later = audit.AuditTrail(tmp_path, run_id='run-2')
+        later.record('third')
+        later.close(timeout=5)
+
+        assert [e['event'] for e in audit.read_events(tmp_path)] == ['first', 'second', 'third']
+
+    def test_close_commits_pending_events(self, tmp_path):
+        """Test that closing the trail writes buffered events."""
+        trail = audit.AuditTrail(tmp_path, batch_size=1000, flush_interval=60)
+        trail.record('report_generated', output='data/report.xlsx')
+        trail.close(timeout=5)
+        trail.record('ignored_after_close')
+
+        assert [e['event'] for e in audit.read_events(tmp_path)] == ['report_generated']
+
+    def test_flush_after_close_returns(self, tmp_path):
+        """Test that flushing a closed trail does not wait for the stopped writer."""
+        trail = audit.AuditTrail(tmp_path, batch_size=1000, flush_interval=60)
+        trail.record('report_generated')
+        trail.close(timeout=5)
+
+        result = []
+        flusher = threading.Thread(target=lambda: result.append(trail.flush()), daemon=True)
+        flusher.start()
+        flusher.join(timeout=5)
+
+        assert not flusher.is_alive(), "flush() should not block after close()"
+        assert result == [True]
+
+    def test_events_recorded_during_close_are_not_lost(self, tmp_path):
+        """Test that every accepted event is committed when close races with record."""
+        trail = audit.AuditTrail(tmp_path, batch_size=1000, flush_interval=60)
+        trail.record('start')
+        accepted = []
+
+        def writer():
+            for i in range(2000):
+                if trail._closed:
+                    break
+                trail.record('invoice_processed', invoice_id=i)
+                accepted.append(i)
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        time.sleep(0.01)
+        trail.close(timeout=5)
+        thread.join(timeout=5)
+
+        committed = [e['invoice_id'] for e in audit.read_events(tmp_path)
+                     if e['event'] == 'invoice_processed']
+        # At most the one record racing the closed check may be dropped
+        assert len(accepted) - len(committed) <= 1
+        assert committed == accepted[:len(committed)]
+
+    def test_record_never_raises(self, tmp_path):
+        """Test that errors while building or queueing events are swallowed."""
+        trail = audit.AuditTrail(tmp_path, flush_interval=60)
+
+        def broken_rows():
+            yield {'invoice_id': 'INV000001'}
+            raise RuntimeError("row source failed")
+
+        try:
+            trail.record_many('invoice_processed', broken_rows())
+            trail.record_many('invoice_processed', [None])
+            trail.record('report_generated')
+        finally:
+            trail.close(timeout=5)
+
+        assert [e['event'] for e in audit.read_events(tmp_path)] == ['report_generated']
+
+    def test_disabled_trail_writes_nothing(self, tmp_path):
+        """Test that a disabled trail never creates files or threads."""
+        trail = audit.AuditTrail(tmp_path / 'audit', enabled=False)
+        trail.record('invoice_processed', invoice_id='INV000001')
+        assert trail.flush(timeout=1)
+        trail.close()
+
+        assert not (tmp_path / 'audit').exists()
+
+
+class TestRetention:
+    """Test the retention sweeper."""
+
+    def test_old_segments_are_removed(self, tmp_path):
+        """Test that segments are aged by file name."""
+        today = date(2025, 6, 30)
+        old = tmp_path / audit.segment_name(today - timedelta(days=91), 'run-1')
+        kept = tmp_path / audit.segment_name(today - timedelta(days=10), 'run-2')
+        other = tmp_path / 'notes.txt'
+        for path in (old, kept, other):
+            path.write_bytes(b'')
+
+        removed = audit.sweep_retention(tmp_path, audit_days=90, today=today)
+
+        assert removed == [str(old)]
+        assert kept.exists() and other.exists()
+
+    def test_rotated_logs_are_removed_by_age(self, tmp_path):
+        """Test that only rotated log files past retention are removed."""
+        log_file = tmp_path / 'automation.log'
+        rotated = tmp_path / 'automation.log.1'
+        recent = tmp_path / 'automation.log.2'
+        for path in (log_file, rotated, recent):
+            path.write_text('log')
+        stale = time.time() - 40 * 86400
+        os.utime(log_file, (stale, stale))
+        os.utime(rotated, (stale, stale))
+
+        removed = audit.sweep_retention(tmp_path / 'audit', log_file=str(log_file), log_days=30)
+
+        assert removed == [str(rotated)]
+        assert log_file.exists() and recent.exists()
+
+
+class TestSettings:
+    """Test loading audit settings."""
+
+    def test_project_settings_enable_audit_trail(self, monkeypatch):
+        """Test that the shipped settings.yaml enables the audit trail."""
+        if audit.yaml is None:
+            pytest.skip("PyYAML not installed")
+        monkeypatch.delenv(audit.ENABLED_ENV_VAR, raising=False)
+        settings = audit.load_security_settings()
+        assert settings['audit_trail'] is True
+        assert settings['audit']['retention_days'] == 365
+        assert settings['retention']['log_files_days'] == 30
+        assert settings['audit']['batch_size'] == 500
+
+    def test_missing_settings_use_defaults(self, tmp_path, monkeypatch):
+        """Test that a missing settings file leaves the trail disabled."""
+        monkeypatch.delenv(audit.ENABLED_ENV_VAR, raising=False)
+        settings = audit.load_security_settings(tmp_path / 'missing.yaml')
+        assert settings['audit_trail'] is False
+
+    def test_invalid_numbers_fall_back_to_defaults(self, tmp_path, monkeypatch):
+        """Test that malformed security.audit values never reach AuditTrail."""
+        if audit.yaml is None:
+            pytest.skip("PyYAML not installed")
+        monkeypatch.delenv(audit.ENABLED_ENV_VAR, raising=False)
+        settings_file = tmp_path / 'settings.yaml'
+        settings_file.write_text(
+            "security:\n"
+            "  audit_trail: true\n"
+            "  audit:\n"
+            "    batch_size: large\n"
+            "    flush_interval: null\n"
+            "    retention_days: -5\n"
+            "  retention:\n"
+            "    log_files_days: soon\n"
+        )
+
+        settings = audit.load_security_settings(settings_file)
+
+        assert settings['audit']['batch_size'] == 500
+        assert settings['audit']['flush_interval'] == 2.0
+        assert settings['audit']['retention_days'] == 365
+        assert settings['retention']['log_files_days'] == 30
+
+    def test_invalid_settings_do_not_fail_processing(self, tmp_path, monkeypatch):
+        """Test that process_invoices still succeeds with malformed audit settings."""
+        pd = pytest.importorskip('pandas')
+        if audit.yaml is None:
+            pytest.skip("PyYAML not installed")
+        import process_data
+
+        settings_file = tmp_path / 'settings.yaml'
+        settings_file.write_text(
+            "security:\n"
+            "  audit_trail: true\n"
+            "  audit:\n"
+            f"    directory: '{tmp_path / 'audit'}'\n"
+            "    batch_size: large\n"
+        )
+        monkeypatch.delenv(audit.ENABLED_ENV_VAR, raising=False)
+        monkeypatch.setattr(audit, 'SETTINGS_FILE', settings_file)
+        audit.set_audit_trail(None)
+
+        input_file = tmp_path / 'invoices.xlsx'
+        pd.DataFrame({
+            'InvoiceID': ['INV000001'],
+            'Client': ['Abc Corp'],
+            'Amount': [1000.5],
+            'Status': ['paid'],
+            'Date': ['2025-01-15'],
+        }).to_excel(input_file, index=False)
+
+        assert process_data.process_invoices(str(input_file), str(tmp_path / 'out.xlsx')) is True
+        trail = audit.get_audit_trail()
+        assert trail.batch_size == 500
+        trail.close(timeout=5)
+        assert [e['event'] for e in audit.read_events(tmp_path / 'audit')] == ['invoice_processed']
+
+    def test_environment_overrides_settings(self, monkeypatch):
+        """Test that AUDIT_TRAIL_ENABLED overrides security.audit_trail."""
+        monkeypatch.setenv(audit.ENABLED_ENV_VAR, 'false')
+        assert audit.load_security_settings()['audit_trail'] is False
+
+        monkeypatch.setenv(audit.ENABLED_ENV_VAR, 'true')
+        assert audit.load_security_settings(Path('missing.yaml'))['audit_trail'] is True
+
+
+class TestAuditTrailInjection:
+    """Test replacing the process-wide audit trail."""
+
+    def test_set_audit_trail_replaces_global(self, tmp_path):
+        """Test that an injected trail is returned by get_audit_trail."""
+        trail = audit.AuditTrail(tmp_path, enabled=False)
+        previous = audit.set_audit_trail(trail)
+        try:
+            assert audit.get_audit_trail() is trail
+        finally:
+            audit.set_audit_trail(previous)
+
+
+class TestAuditIntegration:
+    """Test the events emitted by the automation steps."""
+
+    def test_process_invoices_records_altered_fields(self, tmp_path):
+        """Test one invoice_processed event per row with the fields cleaning changed."""
+        pd = pytest.importorskip('pandas')
+        import process_data
+
+        input_file = tmp_path / 'invoices.xlsx'
+        output_file = tmp_path / 'processed.xlsx'
+        pd.DataFrame({
+            'InvoiceID': ['INV000001', 'INV000002', 'INV000003'],
+            'Client': ['Abc Corp', 'Xyz Ltd', 'def inc'],
+            'Amount': [1000.5, 250.25, float('nan')],
+            'Status': ['paid', 'PENDING', 'UNPAID'],
+            'Date': ['2025-01-15', '2025-01-16', '2025-01-17'],
+        }).to_excel(input_file, index=False)
+
+        trail = audit.AuditTrail(tmp_path / 'audit', flush_interval=60)
+        assert process_data.process_invoices(str(input_file), str(output_file), audit_trail=trail) is True
+        trail.close(timeout=5)
+
+        events = list(audit.read_events(tmp_path / 'audit'))
+        assert [e['event'] for e in events] == ['invoice_processed'] * 3
+        assert [e['invoice_id'] for e in events] == ['INV000001', 'INV000002', 'INV000003']
+        assert events[0]['altered_fields'] == ['Status']
+        assert events[1]['altered_fields'] == []
+        # A missing amount stays missing and is not reported as altered
+        assert events[2]['altered_fields'] == ['Client']
+
+    def test_process_invoices_without_invoice_ids(self, tmp_path):
+        """Test that inputs without InvoiceID still succeed and are audited by row."""
+        pd = pytest.importorskip('pandas')
+        import process_data
+
+        input_file = tmp_path / 'invoices.xlsx'
+        output_file = tmp_path / 'processed.xlsx'
+        pd.DataFrame({
+            'Client': ['Abc Corp', 'Xyz Ltd'],
+            'Amount': [1000.5, 250.25],
+            'Status': ['PAID', 'pending'],
+            'Date': ['2025-01-15', '2025-01-16'],
+        }).to_excel(input_file, index=False)
+
+        trail = audit.AuditTrail(tmp_path / 'audit', flush_interval=60)
+        assert process_data.process_invoices(str(input_file), str(output_file), audit_trail=trail) is True
+        trail.close(timeout=5)
+
+        assert output_file.exists()
+        events = list(audit.read_events(tmp_path / 'audit'))
+        assert [(e['invoice_id'], e['row'], e['altered_fields']) for e in events] == [
+            (None, 0, []),
+            (None, 1, ['Status']),
+        ]
+
+    def test_missing_column_error_is_unchanged(self, tmp_path, capsys):
+        """Test that a missing cleaned column fails in the cleaning code as before."""
+        pd = pytest.importorskip('pandas')
+        import process_data
+
+        input_file = tmp_path / 'invoices.xlsx'
+        pd.DataFrame({
+            'InvoiceID': ['INV000001'],
+            'Client': ['Abc Corp'],
+            'Amount': [1000.5],
+            'Date': ['2025-01-15'],
+        }).to_excel(input_file, index=False)
+
+        trail = audit.AuditTrail(tmp_path / 'audit', enabled=False)
+        assert process_data.process_invoices(str(input_file), str(tmp_path / 'out.xlsx'),
+                                             audit_trail=trail) is False
+        assert "Error processing data: 'Status'" in capsys.readouterr().out
+
+    def test_generate_report_records_event(self, tmp_path):
+        """Test that generate_report records the invoices included in the report."""
+        pd = pytest.importorskip('pandas')
+        import generate_report
+
+        input_file = tmp_path / 'processed.xlsx'
+        output_file = tmp_path / 'report.xlsx'
+        pd.DataFrame({
+            'InvoiceID': ['INV000001', 'INV000002'],
+            'Client': ['Abc Corp', 'Xyz Ltd'],
+            'Amount': [1000.5, 250.25],
+            'Status': ['PAID', 'PENDING'],
+            'Date': ['2025-01-15', '2025-01-16'],
+        }).to_excel(input_file, index=False)
+
+        trail = audit.AuditTrail(tmp_path / 'audit', flush_interval=60)
+        assert generate_report.generate_report(str(input_file), str(output_file), audit_trail=trail) is True
+        trail.close(timeout=5)
+
+        events = list(audit.read_events(tmp_path / 'audit'))
+        assert len(events) == 1
+        assert events[0]['event'] == 'report_generated'
+        assert events[0]['output'] == str(output_file)
+        assert events[0]['invoice_ids'] == ['INV000001', 'INV000002']
+        assert events[0]['total_invoices'] == 2
+        assert events[0]['total_amount'] == pytest.approx(1250.75)
+
+    def test_audit_errors_do_not_fail_steps(self, tmp_path, monkeypatch):
+        """Test that a failing audit trail leaves successful steps successful."""
+        pd = pytest.importorskip('pandas')
+        import generate_report
+        import send_email
+
+        class FakeSMTP:
+            def __init__(self, server, port):
+                pass
+
+            def __getattr__(self, name):
+                return lambda *args: None
+
+        trail = audit.AuditTrail(tmp_path / 'audit', flush_interval=60)
+        monkeypatch.setattr(trail, '_start_writer', lambda: 1 / 0)
+
+        input_file = tmp_path / 'processed.xlsx'
+        pd.DataFrame({
+            'InvoiceID': ['INV000001'],
+            'Amount': [1000.5],
+        }).to_excel(input_file, index=False)
+
+        assert generate_report.generate_report(str(input_file), str(tmp_path / 'report.xlsx'),
+                                               audit_trail=trail) is True
+        monkeypatch.setattr(send_email.smtplib, 'SMTP', FakeSMTP)
+        assert send_email.send_email(str(tmp_path / 'report.xlsx'), audit_trail=trail) is True
+
+    def test_send_email_records_sent_and_failed(self, tmp_path, monkeypatch):
+        """Test that send_email records email_sent and email_failed events."""
+        import send_email
+
+        class FakeSMTP:
+            def __init__(self, server, port):
+                pass
+
+            def starttls(self):
+                pass
+
+            def login(self, username, password):
+                pass
+
+            def sendmail(self, from_addr, to_addr, text):
+                pass
+
+            def quit(self):
+                pass
+
+        class FailingSMTP(FakeSMTP):
+            def login(self, username, password):
+                raise OSError("authentication failed")
+
+        report_file = str(tmp_path / 'report.xlsx')
+        trail = audit.AuditTrail(tmp_path / 'audit', flush_interval=60)
+
+        monkeypatch.setattr(send_email.smtplib, 'SMTP', FakeSMTP)
+        assert send_email.send_email(report_file, to_email='ops@example.com', audit_trail=trail) is True
+
+        monkeypatch.setattr(send_email.smtplib, 'SMTP', FailingSMTP)
+        assert send_email.send_email(report_file, to_email='ops@example.com', audit_trail=trail) is False
+        trail.close(timeout=5)
+
+        events = list(audit.read_events(tmp_path / 'audit'))
+        assert [e['event'] for e in events] == ['email_sent', 'email_failed']
+        assert all(e['recipient'] == 'ops@example.com' and e['report'] == report_file for e in events)
+        assert events[1]['error'] == 'authentication failed'
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])